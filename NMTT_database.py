@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+NMTT: Nano-micromotor Tracking Tool
+
+Results database
+
+@author: Rafael Mestre; r.mestre@soton.ac.uk;
+
+This code collects the results written by NMTT_v1.py for many videos
+into a single SQLite database, so that particles and trajectories of
+different runs can be queried together without reading every file.
+It was written to be compatible Python 3.6+, as well
+as both Windows, Linux and Mac OS.
+
+"""
+
+
+import os
+import re
+import csv
+import math
+import sqlite3
+import datetime
+import easygui
+from tqdm import tqdm
+from pathlib import Path
+
+
+
+
+'''
+#####################
+Parameter definition
+#####################
+These parameters let us select where the database is saved and which
+particles are returned by the query after the results are ingested.
+'''
+
+#Name of the database file. It's created in the selected folder, unless
+#DATABASE_PATH is given with the full path of the database.
+DATABASE_NAME = 'NMTT_results.db'
+DATABASE_PATH = None
+
+#Query options:
+    #after ingesting, the particles that fulfil all the conditions that are not
+    #None are written in NMTT_query.csv, next to the database
+MIN_SPEED = None #in um/s
+MAX_SPEED = None #in um/s
+MIN_DURATION = None #in s
+SINCE = None #date when the video was tracked, as 'YYYY-MM-DD'
+UNTIL = None #date when the video was tracked, as 'YYYY-MM-DD'
+TRACKER = None #one of the TRACKER_TYPES of NMTT_v1.py
+
+
+RESULTS_SUFFIX = '_trackingResults.csv'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    results_file TEXT UNIQUE NOT NULL,
+    video TEXT,
+    modified REAL,
+    tracked_at TEXT,
+    fps REAL,
+    scale REAL,
+    tracker_type TEXT,
+    alpha TEXT,
+    jump_threshold REAL,
+    seconds_stopped REAL
+);
+CREATE TABLE IF NOT EXISTS particles (
+    run_id INTEGER NOT NULL,
+    particle INTEGER NOT NULL,
+    n_points INTEGER,
+    duration REAL,
+    path_length REAL,
+    net_displacement REAL,
+    mean_speed REAL,
+    max_speed REAL,
+    mean_box_size REAL,
+    lost INTEGER,
+    lost_time REAL,
+    PRIMARY KEY (run_id, particle)
+);
+CREATE TABLE IF NOT EXISTS trajectories (
+    run_id INTEGER NOT NULL,
+    particle INTEGER NOT NULL,
+    frame INTEGER NOT NULL,
+    time REAL,
+    x_px REAL,
+    y_px REAL,
+    x_um REAL,
+    y_um REAL,
+    box_x REAL,
+    box_y REAL,
+    box_w REAL,
+    box_h REAL,
+    PRIMARY KEY (run_id, particle, frame)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS events (
+    run_id INTEGER NOT NULL,
+    particle INTEGER,
+    time REAL,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_tracked_at ON runs (tracked_at);
+CREATE INDEX IF NOT EXISTS runs_tracker_type ON runs (tracker_type);
+CREATE INDEX IF NOT EXISTS particles_mean_speed ON particles (mean_speed);
+CREATE INDEX IF NOT EXISTS particles_duration ON particles (duration);
+CREATE INDEX IF NOT EXISTS events_particle ON events (run_id, particle);
+'''
+
+
+
+def connect(databasePath):
+    '''Opens the database, creating the tables and indexes if needed.'''
+
+    conn = sqlite3.connect(str(databasePath))
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def read_table(path, skiprows=1):
+    '''Reads a tab separated file of numbers written by NMTT, skipping the
+    header lines. Returns a list of rows.'''
+
+    with open(path) as ff:
+        lines = ff.read().splitlines()[skiprows:]
+    return [[float(v) for v in line.split('\t')] for line in lines if line.strip()]
+
+
+def read_settings(path):
+    '''Reads a file of "name\\tvalue" lines, such as the settings or the
+    contrast correction files. Returns a dictionary of strings.'''
+
+    settings = dict()
+    if not os.path.exists(path):
+        return settings
+    with open(path) as ff:
+        for line in ff.read().splitlines():
+            values = line.split('\t')
+            if len(values) == 2 and values[0] not in settings:
+                settings[values[0]] = values[1]
+    return settings
+
+
+def find_particles(saveDir, file, suffix):
+    '''Returns the numbers of the particles that have a file called
+    file_pX_suffix in saveDir. A regular expression is used instead of a
+    glob pattern, since the name of the video can contain characters
+    such as "[" or "]".'''
+
+    pattern = re.compile(re.escape(file) + r'_p(\d+)_' + re.escape(suffix) + '$')
+    matches = [pattern.match(f.name) for f in saveDir.iterdir()]
+    return sorted([int(match.group(1)) for match in matches if match])
+
+
+def read_fps(saveDir, file):
+    '''Reads the FPS from the header of the bounding box files, for the runs
+    from before the settings file was saved. Returns None if not found.'''
+
+    for p in find_particles(saveDir, file, 'boundingBox.txt'):
+        with open(Path(saveDir, file+'_p'+str(p)+'_boundingBox.txt')) as ff:
+            values = ff.readline().split('\t')
+        if len(values) == 2 and values[0].startswith('FPS'):
+            return float(values[1])
+    return None
+
+
+def read_events(path):
+    '''Reads the error log of a run. Returns a list of (particle, time, message)
+    for each line, with None if the particle or time are not found.'''
+
+    events = list()
+    if not os.path.exists(path):
+        return events
+    with open(path) as ff:
+        for line in ff.read().splitlines():
+            if not line.strip():
+                continue
+            match = re.match(r'Object (\d+) .*at time ([-+.\deE]+) s\.$', line)
+            if match:
+                events.append((int(match.group(1)), float(match.group(2)), line))
+            else:
+                events.append((None, None, line))
+    return events
+
+
+def summarise(trajectory, boxes):
+    '''Calculates the summary statistics of a particle from its trajectory,
+    given as rows of (time, x, y) in um, and its bounding boxes.
+    Speeds are in um/s.'''
+
+    n = len(trajectory)
+    if n == 0:
+        return dict(n_points=0, duration=0, path_length=0, net_displacement=0,
+                    mean_speed=0, max_speed=0, mean_box_size=None)
+
+    pathLength = 0
+    maxSpeed = 0
+    for (t1, x1, y1), (t2, x2, y2) in zip(trajectory, trajectory[1:]):
+        step = math.hypot(x2-x1, y2-y1)
+        pathLength += step
+        if t2 > t1:
+            maxSpeed = max(maxSpeed, step/(t2-t1))
+
+    duration = trajectory[-1][0] - trajectory[0][0]
+    netDisplacement = math.hypot(trajectory[-1][1]-trajectory[0][1], trajectory[-1][2]-trajectory[0][2])
+    meanBoxSize = sum([(b[2]+b[3])/2. for b in boxes])/len(boxes) if boxes else None
+
+    return dict(n_points=n, duration=duration, path_length=pathLength,
+                net_displacement=netDisplacement,
+                mean_speed=pathLength/duration if duration > 0 else 0,
+                max_speed=maxSpeed, mean_box_size=meanBoxSize)
+
+
+def ingest_run(conn, resultsFile):
+    '''Loads the results of one video in the database, from its
+    _trackingResults.csv file and the folder created next to it.
+    If the run was already ingested and hasn't changed since, it's skipped.
+    If it has changed, it's replaced. Returns True if it was ingested.'''
+
+    resultsFile = Path(resultsFile).resolve()
+    modified = os.path.getmtime(resultsFile)
+
+    row = conn.execute('SELECT run_id, modified FROM runs WHERE results_file = ?',
+                       (str(resultsFile),)).fetchone()
+    if row is not None and row[1] == modified:
+        return False
+
+    file = resultsFile.name[:-len(RESULTS_SUFFIX)]
+    saveDir = Path(resultsFile.parent, file)
+
+    #Runs without results are reported as failed instead of being stored empty
+    if not saveDir.is_dir():
+        raise Exception('The results folder {} does not exist.'.format(saveDir))
+    #The particles are found from the files of the trajectories in pixels
+    particles = find_particles(saveDir, file, 'trackingCV2pixels.txt')
+    if len(particles) == 0:
+        raise Exception('No particle results found in {}.'.format(saveDir))
+
+    settings = read_settings(Path(saveDir, file+'_settings.txt'))
+    contrast = read_settings(Path(saveDir, file+'_contrastCorrection.txt'))
+
+    #Runs from before the settings file was saved only have the tracker
+    #type in the name of the video, the FPS in the bounding box files, and
+    #the date when the results were last modified
+    trackerType = settings.get('TRACKER_TYPE')
+    if trackerType is None:
+        pattern = re.compile(re.escape(file) + r'_TRACKING_(.+)\.avi$')
+        for video in saveDir.iterdir():
+            match = pattern.match(video.name)
+            if match:
+                trackerType = match.group(1)
+    fps = settings.get('FPS')
+    if fps is None:
+        fps = read_fps(saveDir, file)
+    trackedAt = settings.get('DATE')
+    if trackedAt is None:
+        trackedAt = datetime.datetime.fromtimestamp(modified).isoformat(sep=' ', timespec='seconds')
+
+    def to_float(value):
+        return float(value) if value is not None else None
+
+    #Each run is replaced in a single transaction
+    with conn:
+        if row is not None:
+            for table in ['events', 'trajectories', 'particles', 'runs']:
+                conn.execute('DELETE FROM {} WHERE run_id = ?'.format(table), (row[0],))
+
+        runId = conn.execute('''INSERT INTO runs (results_file, video, modified, tracked_at, fps,
+                                scale, tracker_type, alpha, jump_threshold, seconds_stopped)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                             (str(resultsFile), file, modified, trackedAt,
+                              to_float(fps), to_float(settings.get('SCALE')),
+                              trackerType, contrast.get('alpha'),
+                              to_float(settings.get('JUMP_THRESHOLD')),
+                              to_float(settings.get('SECONDS_STOPPED')))).lastrowid
+
+        events = read_events(Path(saveDir, 'errorLog.txt'))
+        conn.executemany('INSERT INTO events (run_id, particle, time, message) VALUES (?, ?, ?, ?)',
+                         [(runId, p, t, message) for p, t, message in events])
+
+        for p in particles:
+            pixels = read_table(Path(saveDir, file+'_p'+str(p)+'_trackingCV2pixels.txt'))
+            um = read_table(Path(saveDir, file+'_p'+str(p)+'_tracking_um_norm.txt'))
+            boxes = read_table(Path(saveDir, file+'_p'+str(p)+'_boundingBox.txt'))
+
+            conn.executemany('''INSERT INTO trajectories (run_id, particle, frame, time, x_px, y_px,
+                                x_um, y_um, box_x, box_y, box_w, box_h)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                             [(runId, p, i, pixels[i][0], pixels[i][1], pixels[i][2],
+                               um[i][1], um[i][2], *(boxes[i] if i < len(boxes) else [None]*4))
+                              for i in range(min(len(pixels), len(um)))])
+
+            #The particle was lost if it appears in the error log, at the
+            #time of its first event
+            lostTimes = [t for q, t, message in events if q == p and t is not None]
+            summary = summarise(um, boxes)
+            conn.execute('''INSERT INTO particles (run_id, particle, n_points, duration, path_length,
+                            net_displacement, mean_speed, max_speed, mean_box_size, lost, lost_time)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                         (runId, p, summary['n_points'], summary['duration'], summary['path_length'],
+                          summary['net_displacement'], summary['mean_speed'], summary['max_speed'],
+                          summary['mean_box_size'], int(len(lostTimes) > 0),
+                          min(lostTimes) if lostTimes else None))
+
+    return True
+
+
+def ingest_folder(conn, folder):
+    '''Looks for all the _trackingResults.csv files inside the folder and
+    its subfolders, and ingests the runs that are new or have changed.
+    A run that can't be read (e.g. missing or truncated files) is reported
+    and left out, without stopping the rest.
+    Returns the number of runs ingested, skipped and failed.'''
+
+    resultsFiles = sorted(Path(folder).rglob('*'+RESULTS_SUFFIX))
+    ingested = 0
+    failed = 0
+    for resultsFile in tqdm(resultsFiles):
+        try:
+            if ingest_run(conn, resultsFile):
+                ingested += 1
+        except Exception as e:
+            print('Could not ingest {}: {}'.format(resultsFile, e))
+            failed += 1
+    return ingested, len(resultsFiles) - ingested - failed, failed
+
+
+def query_particles(conn, min_speed=None, max_speed=None, min_duration=None,
+                    since=None, until=None, tracker_type=None):
+    '''Returns the particles fulfilling all the conditions that are not None,
+    as a list of dictionaries with the particle summary and its run.
+    Speeds are in um/s and durations in s. since and until are dates
+    as 'YYYY-MM-DD', compared with the date when the video was tracked.'''
+
+    conditions = list()
+    values = list()
+    if min_speed is not None:
+        conditions.append('p.mean_speed >= ?')
+        values.append(min_speed)
+    if max_speed is not None:
+        conditions.append('p.mean_speed <= ?')
+        values.append(max_speed)
+    if min_duration is not None:
+        conditions.append('p.duration >= ?')
+        values.append(min_duration)
+    if since is not None:
+        conditions.append('r.tracked_at >= ?')
+        values.append(since)
+    if until is not None:
+        #The whole day is included
+        conditions.append('r.tracked_at < date(?, \'+1 day\')')
+        values.append(until)
+    if tracker_type is not None:
+        conditions.append('r.tracker_type = ?')
+        values.append(tracker_type)
+
+    query = '''SELECT r.run_id, r.video, r.results_file, r.tracked_at, r.fps, r.scale,
+               r.tracker_type, r.alpha, p.particle, p.n_points, p.duration, p.path_length,
+               p.net_displacement, p.mean_speed, p.max_speed, p.mean_box_size, p.lost, p.lost_time
+               FROM particles p JOIN runs r ON p.run_id = r.run_id'''
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY r.tracked_at, r.run_id, p.particle'
+
+    cursor = conn.execute(query, values)
+    names = [c[0] for c in cursor.description]
+    return [dict(zip(names, row)) for row in cursor]
+
+
+def get_trajectory(conn, run_id, particle):
+    '''Returns the trajectory of a particle as a list of
+    (time, x in um, y in um) rows.'''
+
+    return conn.execute('''SELECT time, x_um, y_um FROM trajectories
+                           WHERE run_id = ? AND particle = ? ORDER BY frame''',
+                        (run_id, particle)).fetchall()
+
+
+
+def main():
+
+    dn = os.path.dirname(os.path.realpath(__file__))
+
+    folder = easygui.diropenbox(default=dn)
+    if folder is None:
+        raise Exception('Folder not selected.')
+
+    if DATABASE_PATH is not None:
+        databasePath = Path(DATABASE_PATH)
+    else:
+        databasePath = Path(folder, DATABASE_NAME)
+
+    conn = connect(databasePath)
+
+    print("\nIngesting results. Please wait...")
+    ingested, skipped, failed = ingest_folder(conn, folder)
+    print('{} runs ingested, {} runs already up to date, {} runs failed.'.format(ingested, skipped, failed))
+
+    #Writes the particles of the query in file
+    particles = query_particles(conn, min_speed=MIN_SPEED, max_speed=MAX_SPEED,
+                                min_duration=MIN_DURATION, since=SINCE, until=UNTIL,
+                                tracker_type=TRACKER)
+    print('{} particles found.'.format(len(particles)))
+
+    if particles:
+        with open(Path(databasePath.parent, 'NMTT_query.csv'), 'w', newline="") as ff:
+            writer = csv.DictWriter(ff, fieldnames=list(particles[0].keys()))
+            writer.writeheader()
+            writer.writerows(particles)
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
+
+
@@ -20,8 +20,10 @@ import cv2
 import easygui
 import seaborn as sns
 import csv
+import datetime
 from tqdm import tqdm
 from itertools import compress
+from collections import deque
 from pathlib import Path
 
 
@@ -79,6 +81,44 @@ JUMP_THRESHOLD = 0.5
 SECONDS_STOPPED = 0.7
 
 
+#The adaptive stride lets the code track only every Nth frame when the particles
+#move very slowly (e.g. high FPS videos), which makes the tracking faster.
+#The positions of the skipped frames are interpolated, so the results still
+#have one value per frame. The stride N is increased by one while the motion
+#expected during the stride is smaller than STRIDE_DISPLACEMENT times the
+#average dimension of the bounding box, and it goes back to 1 as soon as the
+#particles move more than that. N is never larger than MAX_STRIDE, or than the
+#number of frames given by SECONDS_STOPPED, so that the stuck check always
+#uses at least one tracked position.
+ADAPTIVE_STRIDE = False
+MAX_STRIDE = 5
+STRIDE_DISPLACEMENT = 0.1
+
+
+#The automatic contrast replaces the manual contrast adjustment. It is meant
+#for fluorescent videos (bright particles on a dark background), where the
+#photobleaching makes the signal drift during the video. Before tracking, the
+#video is read once and NORMALISATION_SAMPLES frames are sampled evenly.
+#The background of each sample is found with a morphological opening of
+#NORMALISATION_KERNEL pixels, which removes the particles whether they move
+#or not (so it must be larger than the particles), and it's then averaged with
+#the median of the NORMALISATION_WINDOW closest samples. If
+#NORMALISATION_BACKGROUND is True, the background is subtracted from the frames.
+#Then, the intensity is multiplied by a gain that takes the particles to the
+#maximum (255), up to a maximum gain of MAX_GAIN. The particles are the pixels
+#more than NORMALISATION_NOISE times the noise above the background, and the
+#NORMALISATION_PERCENTILE of their intensity is used. The gain is interpolated
+#between samples for every frame.
+AUTO_CONTRAST = False
+NORMALISATION_BACKGROUND = True
+NORMALISATION_SAMPLES = 30
+NORMALISATION_WINDOW = 9
+NORMALISATION_KERNEL = 51
+NORMALISATION_NOISE = 5
+NORMALISATION_PERCENTILE = 99
+MAX_GAIN = 10
+
+
 # Set up tracker.
 TRACKER_TYPES = ['BOOSTING', 'MIL','KCF', 'TLD', 'MEDIANFLOW', 'GOTURN', 'MOSSE', 'CSRT']
 TRACKER_TYPE = TRACKER_TYPES[7] #Best performing one is CSRT
@@ -174,6 +214,268 @@ def generate_tracker(type_of_tracker):
 
 
 
+def interpolate_center(center0, bbox1, w):
+    '''Interpolates linearly between the center center0 of the last tracked
+    frame and the center of the bounding box bbox1 of the next tracked frame.
+    w goes from 0 (center0) to 1 (center of bbox1).'''
+
+    if center0 == (-1,-1):
+        return (-1,-1)
+    center1 = (int(bbox1[0] + bbox1[2]/2.),int(bbox1[1] + bbox1[3]/2.))
+    return (int(round(center0[0]*(1-w) + center1[0]*w)),
+            int(round(center0[1]*(1-w) + center1[1]*w)))
+
+
+def is_stuck(centerList, row, index, framesStopped):
+    '''Tells if the particle with the given index is stuck at the given row
+    of centerList, using only the rows before it.
+    If the following happens, we consider it hasn't moved,
+    meaning it has lost the object.
+    This is just a very simple way of considering the center of the particle
+    has barely changed in framesStopped frames, which means the particle has
+    been lost and the tracker is not following anything.'''
+
+    if row <= framesStopped:
+        return False
+    awayFromCenter = sum([np.linalg.norm(np.array(c[index-1])-np.array(centerList[row-1][index-1])) for c in centerList[row-framesStopped:row-1]])
+    return awayFromCenter <= framesStopped
+
+
+def update_stride(stride, lastCenters, centers, bboxes, trackedIds, nbFrames, maxStride):
+    '''Calculates the stride for the next tracked frame from the displacement
+    of the particles since the last tracked frame, nbFrames ago.
+    The displacement per frame is relative to the average dimension of the
+    bounding box. The stride goes back to 1 if the motion during the current
+    stride is larger than STRIDE_DISPLACEMENT, and it is increased by 1 if the
+    motion during the next stride would still be smaller than that.
+    It also goes back to 1 if the displacement can't be calculated, e.g. for
+    a bounding box without width or height.'''
+
+    if len(trackedIds) == 0:
+        return 1
+    if any([bboxes[index-1][2] <= 0 or bboxes[index-1][3] <= 0 for index in trackedIds]):
+        return 1
+
+    displacement = max([np.linalg.norm(np.array(centers[index-1])-np.array(lastCenters[index-1]))/nbFrames/
+                        np.mean([bboxes[index-1][2],bboxes[index-1][3]]) for index in trackedIds])
+
+    if not np.isfinite(displacement) or displacement*stride > STRIDE_DISPLACEMENT:
+        return 1
+    elif displacement*(stride+1) <= STRIDE_DISPLACEMENT:
+        return min(stride+1, maxStride)
+    return stride
+
+
+def sample_gain(frame, background):
+    '''Calculates the gain that takes the signal of the particles of a sampled
+    frame to 255, and the level left after subtracting its background
+    (kept at a smaller size). The particles are the pixels more than
+    NORMALISATION_NOISE times the noise above the level.'''
+
+    if NORMALISATION_BACKGROUND:
+        background = cv2.resize(background, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_LINEAR)
+        residual = cv2.subtract(frame, background).ravel()
+    else:
+        residual = frame.ravel()
+    #The noise is estimated from the median absolute deviation
+    level = float(np.median(residual))
+    deviation = residual.astype(np.float32)
+    deviation -= level
+    noise = 1.4826*np.median(np.abs(deviation, out=deviation))
+    foreground = residual[residual > level + max(NORMALISATION_NOISE*noise, 1)]
+    signal = np.percentile(foreground, NORMALISATION_PERCENTILE) if foreground.size > 0 else 0
+    #With the background, its remaining level is subtracted too
+    if not NORMALISATION_BACKGROUND:
+        level = 0
+    return level, min(255/max(signal-level, 1), MAX_GAIN)
+
+
+def estimate_normalisation(video, length):
+    '''Estimates the background and gain of the video for the automatic
+    contrast, in a single pass through the video. Only the sampled frames
+    are decoded. Returns a dictionary with the sampled frame indexes, their
+    backgrounds and gains and, for each frame, its gain, the level left after
+    subtracting the background and the index of its background.'''
+
+    nbSamples = max(1, min(NORMALISATION_SAMPLES, length))
+    sampleIndexes = np.unique(np.linspace(0, max(length-1, 0), nbSamples).astype(int))
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (NORMALISATION_KERNEL, NORMALISATION_KERNEL))
+
+    #The video is read only until the last sampled frame. The opening is
+    #smoothed to avoid the blocks of the rectangular kernel. Only the openings
+    #of the rolling window, and the samples waiting for their window to be
+    #complete, are kept in memory. Since they are smooth, the openings and
+    #backgrounds are kept at 1/4 of the size of the frames
+    openings = deque(maxlen=NORMALISATION_WINDOW)
+    waiting = deque()
+    backgrounds = list()
+    levels = list()
+    gains = list()
+    nbRead = 0
+    for i in range(sampleIndexes[-1]+1):
+        if i == sampleIndexes[nbRead]:
+            ok, frame = video.read()
+            if ok:
+                nbRead += 1
+                opening = cv2.morphologyEx(frame, cv2.MORPH_OPEN, kernel)
+                opening = cv2.blur(opening, (NORMALISATION_KERNEL, NORMALISATION_KERNEL))
+                openings.append(cv2.resize(opening, (0,0), fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA))
+                waiting.append(frame)
+                #The rolling median of a sample is centered on it, except at
+                #the ends of the video. It's calculated as soon as the last
+                #opening of its window has been read
+                while waiting:
+                    start = min(max(0, len(backgrounds)-NORMALISATION_WINDOW//2), max(0, len(sampleIndexes)-NORMALISATION_WINDOW))
+                    if min(start+NORMALISATION_WINDOW, len(sampleIndexes)) > nbRead:
+                        break
+                    background = np.median(list(openings), axis=0).astype(np.uint8)
+                    level, gain = sample_gain(waiting.popleft(), background)
+                    backgrounds.append(background)
+                    levels.append(level)
+                    gains.append(gain)
+        else:
+            ok = video.grab()
+        if not ok:
+            break
+
+    if nbRead == 0:
+        raise Exception('Could not read the video to estimate the contrast.')
+    sampleIndexes = sampleIndexes[:nbRead]
+
+    #If the video ended before the last sample, the samples still waiting
+    #use the last openings that were read
+    while waiting:
+        background = np.median(list(openings), axis=0).astype(np.uint8)
+        level, gain = sample_gain(waiting.popleft(), background)
+        backgrounds.append(background)
+        levels.append(level)
+        gains.append(gain)
+
+    frames = np.arange(max(length, sampleIndexes[-1]+1))
+    frameGains = np.interp(frames, sampleIndexes, gains)
+    frameLevels = np.interp(frames, sampleIndexes, levels)
+    bgIndexes = np.round(np.interp(frames, sampleIndexes, np.arange(len(sampleIndexes)))).astype(int)
+
+    return {'sampleIndexes': sampleIndexes, 'backgrounds': backgrounds, 'gains': gains,
+            'frameGains': frameGains, 'frameLevels': frameLevels, 'bgIndexes': bgIndexes}
+
+
+def normalise_frame(frame, index, normalisation):
+    '''Applies the automatic contrast to the frame with the given index,
+    in place and in a single pass. The background is subtracted (if
+    NORMALISATION_BACKGROUND is True) and the gain is applied at the same time.'''
+
+    index = min(index, len(normalisation['frameGains'])-1)
+    gain = normalisation['frameGains'][index]
+    if NORMALISATION_BACKGROUND:
+        #The background is resized to the size of the frame only when it changes
+        bgIndex = normalisation['bgIndexes'][index]
+        if normalisation.get('currentIndex') != bgIndex:
+            normalisation['currentIndex'] = bgIndex
+            normalisation['currentBackground'] = cv2.resize(normalisation['backgrounds'][bgIndex],
+                                                            (frame.shape[1], frame.shape[0]),
+                                                            interpolation=cv2.INTER_LINEAR)
+        background = normalisation['currentBackground']
+        level = normalisation['frameLevels'][index]
+        cv2.addWeighted(frame, gain, background, -gain, -gain*level, dst=frame)
+    else:
+        cv2.convertScaleAbs(frame, dst=frame, alpha=gain)
+    return frame
+
+
+def draw_overlay(frame, bboxes, boxIds, labelIds, centerList, elapsed, fps, cmap):
+    '''Draws the bounding boxes, particle numbers, trajectories and information
+    text on the frame, according to the display options.
+    Returns the frame resized with the scaling factor f, with the same
+    drawings, or the frame itself if f is 1.'''
+
+    height, width = frame.shape[:2]
+
+    #Resize only if f is less than 1
+    if f != 1:
+        frameResized = cv2.resize(frame,(0,0),fx=f,fy=f)
+    else:
+        frameResized = frame
+
+    # Draw bounding box
+    # only if the particle was not lost
+    if DISPLAY_BOX:
+        for index in boxIds:
+            bbox = bboxes[index-1]
+            if f != 1:
+                bboxScaled = tuple([b*f for b in bbox])
+                p1Scaled = (int(bboxScaled[0]), int(bboxScaled[1]))
+                p2Scaled = (int(bboxScaled[0] + bboxScaled[2]), int(bboxScaled[1] + bboxScaled[3]))
+                cv2.rectangle(frameResized, p1Scaled, p2Scaled, (255,102,102),thickness=2)
+            p1 = (int(bbox[0]), int(bbox[1]))
+            p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
+            cv2.rectangle(frame, p1, p2, (255,102,102),thickness=2)
+
+    #Loop through the CURRENT PARTICLES only
+    if DISPLAY_PARTICLE_NUMBER:
+        for label in labelIds:
+            bbox = bboxes[label-1]
+            #This part adds the particle label next to the bounding box
+            if f != 1:
+                bboxScaled = tuple([b*f for b in bbox])
+                cv2.putText(frameResized, str(label),
+                            (int(bboxScaled[0]+bboxScaled[2]),int(bboxScaled[1])),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255),2)
+            cv2.putText(frame, str(label),
+                        (int(bbox[0]+bbox[2]),int(bbox[1])),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255),2)
+
+    #If we want to display the tracking with colors
+    if DISPLAY_TRACKING:
+        centerList_T = list(zip(*centerList))
+        for idx in labelIds:
+            count2 = 0
+            for point1, point2 in zip(centerList_T[idx-1], centerList_T[idx-1][1:]):
+                if point1 != (-1,-1) and point2 != (-1,-1):
+                    color = (int(cmap[count2][2]*255),int(cmap[count2][1]*255),int(cmap[count2][0]*255))
+                    if f != 1:
+                        p1Scaled = tuple([int(p1*f) for p1 in point1])
+                        p2Scaled = tuple([int(p2*f) for p2 in point2])
+                        cv2.line(frameResized, p1Scaled, p2Scaled, color, 3)
+                    cv2.line(frame, point1, point2, color, 3)
+                    count2 += 1
+
+    # Display tracker type on frame
+    if DISPLAY_TRACKER:
+        if f != 1:
+            cv2.putText(frameResized, TRACKER_TYPE + " Tracker", (int(f*width*0.15),int(f*height*0.05+GENERAL_OFFSET*f)), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (50,170,50),2)
+        cv2.putText(frame, TRACKER_TYPE + " Tracker", (int(width*0.15),int(height*0.05)+GENERAL_OFFSET), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255),2)
+
+    # Display FPS on frame
+    if DISPLAY_FPS:
+        if f != 1:
+            cv2.putText(frameResized, "FPS: " + str(fps), (int(f*width*0.15),int(f*height*0.05+GENERAL_OFFSET*f)+30), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (50,170,50), 2)
+        cv2.putText(frame, "FPS: " + str(fps), (int(width*0.15),int(height*0.05)+30+GENERAL_OFFSET), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255), 2)
+
+    # Display elapsed time
+    if DISPLAY_TIME:
+        if f != 1:
+            cv2.putText(frameResized, "Time: " + "%.2f s" % elapsed, (int(f*width*0.15),int(f*height*0.05+GENERAL_OFFSET*f)+60), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (50,170,50), 2)
+        cv2.putText(frame, "Time: " + "%.2f s" % elapsed, (int(width*0.15),int(height*0.05)+60+GENERAL_OFFSET), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255), 2)
+
+    # Display scale bar
+    if DISPLAY_SCALE_BAR:
+        p1 = (int(width*0.7),int(height*0.07)+GENERAL_OFFSET)
+        p2 = (int(width*0.7+SCALE_NUMBER*SCALE),int(height*0.075)+GENERAL_OFFSET)
+        cv2.rectangle(frame, p1,p2, (255,255,255), -1)
+        if f != 1:
+            p1Scaled = (int(p1[0]*f),int(p1[1]*f))
+            p2Scaled = (int(p2[0]*f),int(p2[1]*f))
+            cv2.rectangle(frameResized, p1Scaled,p2Scaled, (255,255,255), -1)
+        if DISPLAY_SCALE_BAR_TEXT:
+            if f != 1:
+                cv2.putText(frameResized,str(SCALE_NUMBER) + ' um',(int(f*width*0.7),int(f*height*0.06+GENERAL_OFFSET*f)),cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255), 2)
+            cv2.putText(frame,str(SCALE_NUMBER) + ' um',(int(width*0.72),int(height*0.06)+GENERAL_OFFSET),cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255), 2)
+
+    return frameResized
+
+
+
 def main():
 
     global f
@@ -226,6 +528,14 @@ def main():
     
     
     
+    # With the automatic contrast, the background and gain are estimated
+    # reading the video once, and then it's opened again from the start
+    if AUTO_CONTRAST:
+        print("\nEstimating contrast. Please wait...")
+        normalisation = estimate_normalisation(video, length)
+        video.release()
+        video = cv2.VideoCapture(str(fileName))
+    
     # Read first frame.
     ok, initialFrame = video.read()
     if not ok:
@@ -243,45 +553,51 @@ def main():
     '''
     
     
-    #Frame is resized if f is different from 1
-    frameResized = cv2.resize(initialFrame,(0,0),fx=f,fy=f)    
+    #If the automatic contrast is used, no manual adjustment is needed
+    if AUTO_CONTRAST:
+        alpha = 'auto'
+        initialFrame = normalise_frame(initialFrame, 0, normalisation)
+        frameResized = cv2.resize(initialFrame,(0,0),fx=f,fy=f)
+    else:
+        #Frame is resized if f is different from 1
+        frameResized = cv2.resize(initialFrame,(0,0),fx=f,fy=f)    
     
-    #Creates window
-    title_window = 'Contrast adjustment'
-    cv2.namedWindow(title_window,cv2.WINDOW_AUTOSIZE )
+        #Creates window
+        title_window = 'Contrast adjustment'
+        cv2.namedWindow(title_window,cv2.WINDOW_AUTOSIZE )
     
-    #Creates trackbar
-    trackbar_name = '(x10)'
-    cv2.createTrackbar(trackbar_name, title_window , 10, 100, on_trackbar)
+        #Creates trackbar
+        trackbar_name = '(x10)'
+        cv2.createTrackbar(trackbar_name, title_window , 10, 100, on_trackbar)
         
-    #Infinite loop stopping if the letter q is pressed
-    while True:
+        #Infinite loop stopping if the letter q is pressed
+        while True:
     
-        #The alpha value is by default 10. It is divided by 10 because
-        #the tracking bar doesn't allow decimals. Alpha = 1 means image is unchanged.
-        alpha = cv2.getTrackbarPos(trackbar_name,title_window)/10    
+            #The alpha value is by default 10. It is divided by 10 because
+            #the tracking bar doesn't allow decimals. Alpha = 1 means image is unchanged.
+            alpha = cv2.getTrackbarPos(trackbar_name,title_window)/10    
         
-        #The scale is trasnformed with the specified alpha value
-        frameBeta = cv2.convertScaleAbs(frameResized, alpha=alpha, beta=0)
+            #The scale is trasnformed with the specified alpha value
+            frameBeta = cv2.convertScaleAbs(frameResized, alpha=alpha, beta=0)
     
-        cv2.imshow(title_window,frameBeta)
+            cv2.imshow(title_window,frameBeta)
         
-        # Wait for keypress
-        k = cv2.waitKey(1) & 0xff
+            # Wait for keypress
+            k = cv2.waitKey(1) & 0xff
          
-        # Stop if 'q' is pressed            
-        if k == 27:
-            break
+            # Stop if 'q' is pressed            
+            if k == 27:
+                break
     
-    cv2.destroyAllWindows()
+        cv2.destroyAllWindows()
     
-    # Error handling
-    if alpha < 0:
-        raise Exception('Something went wrong with the contrast setting...\n Do not close the window with the "x", but pressing "q".')
+        # Error handling
+        if alpha < 0:
+            raise Exception('Something went wrong with the contrast setting...\n Do not close the window with the "x", but pressing "q".')
     
-    # Changes are applied
-    frameResized = cv2.convertScaleAbs(frameResized, alpha=alpha, beta=0)
-    initialFrame = cv2.convertScaleAbs(initialFrame, alpha=alpha, beta=0)
+        # Changes are applied
+        frameResized = cv2.convertScaleAbs(frameResized, alpha=alpha, beta=0)
+        initialFrame = cv2.convertScaleAbs(initialFrame, alpha=alpha, beta=0)
     
     
     
@@ -393,14 +709,31 @@ def main():
     keepDict = dict([(ID, True) for ID in ids])
     errorLog = list()
     
+    #Conversion of the stride limit, so that the stuck check (done in frames)
+    #always has at least one tracked position in its window
+    maxStride = max(1, min(MAX_STRIDE, framesStopped))
+    stride = 1
+    skippedFrames = list()
+    videoEnded = False
+    frame = None
+    
     #Tracking starts, press ESC if you want to finish early
     while True:
         
         # Read a new frame
-        ok, frame = video.read()
+        #Without the adaptive stride, it's read in the same buffer every time
+        if ADAPTIVE_STRIDE:
+            ok, frame = video.read()
+        else:
+            ok, frame = video.read(frame)
     
         #Frame contrast is adjusted according to alpha before
-        frame = cv2.convertScaleAbs(frame, alpha=alpha, beta=0)
+        #or automatically, in place
+        if AUTO_CONTRAST:
+            if ok:
+                normalise_frame(frame, count+1, normalisation)
+        else:
+            frame = cv2.convertScaleAbs(frame, alpha=alpha, beta=0)
     
         count += 1
         # pbar.updtate()
@@ -412,37 +745,75 @@ def main():
         
         if not ok:
             #Most likely, the video has ended
-            break
-        
-        #Resize only if f is less than 1
-        if f != 1:
-            frameResized = cv2.resize(frame,(0,0),fx=f,fy=f)        
+            if len(skippedFrames) == 0:
+                break
+            #If there are skipped frames, the last one is tracked so that the
+            #rest can be interpolated
+            frame = skippedFrames.pop()
+            count -= 1
+            videoEnded = True
+        elif ADAPTIVE_STRIDE and len(skippedFrames) < stride-1:
+            #This frame is not tracked, its position will be interpolated
+            #when the next frame is tracked
+            skippedFrames.append(frame)
+            continue
     
         # Update tracker
         ok, bboxes = multi_tracker.update(frame)
-        bounding_box_list.append(bboxes)
             
         if not ok:
             print('Tracker error')
             
-        #Time elapsed
-        elapsed = count/fps
-        timeList.append(elapsed)
+        #Time elapsed, for the skipped frames and this one
+        for c in range(count-len(skippedFrames), count+1):
+            timeList.append(c/fps)
         
-        #This piece of code tells you if one of the particles was lost in the
-        #previous frame, according to the keepDict.
-        nb_Trues = len(ID_array[-1])
-        ID_array.append(list(compress(ids, keepDict.values())))
+            #This piece of code tells you if one of the particles was lost in the
+            #previous frame, according to the keepDict.
+            nb_Trues = len(ID_array[-1])
+            ID_array.append(list(compress(ids, keepDict.values())))
+            
+            if nb_Trues != sum(keepDict.values()):
+                missing_ids = list(set(ID_array[-1]).symmetric_difference(set(ID_array[-2])))
+                print('Tracker lost')
+                # print(keepDict)
+                [errorLog.append('Object {} lost at time {} s.'.format(p, timeList[-2])) for p in missing_ids]
+        elapsed = timeList[-1]
+        
+        #The bounding boxes and centers of the skipped frames are interpolated
+        #between the last tracked frame and this one
+        lastBboxes = np.asarray(bounding_box_list[-1], dtype=float)
+        lastCenters = centerList[-1]
+        for j in range(1, len(skippedFrames)+1):
+            w = j/(len(skippedFrames)+1)
+            bounding_box_list.append((1-w)*lastBboxes + w*np.asarray(bboxes, dtype=float))
+            centerList.append([interpolate_center(lastCenters[index-1], bboxes[index-1], w) if index in ID_array[-1] else (-1,-1) for index in ids])
+        bounding_box_list.append(bboxes)
         
-        if nb_Trues != sum(keepDict.values()):
-            missing_ids = list(set(ID_array[-1]).symmetric_difference(set(ID_array[-2])))
-            print('Tracker lost')
-            # print(keepDict)
-            [errorLog.append('Object {} lost at time {} s.'.format(p, timeList[-2])) for p in missing_ids]
+        #The stuck check is also done for the skipped frames, so that the
+        #particle is stopped at the first frame where it was already stuck
+        for index in list(ID_array[-1]):
+            for row in range(len(centerList)-len(skippedFrames), len(centerList)):
+                if is_stuck(centerList, row, index, framesStopped):
+                    keepDict[index] = False
+                    print('Object was lost')
+                    errorLog.append('Object {} was lost for {} seconds and tracker stopped at time {} s.'.format(index,
+                                                                                                                 round(framesStopped/fps,2),
+                                                                                                                 timeList[row]))
+                    #As with stride 1, this is only logged if the tracking continues
+                    if True in keepDict.values():
+                        errorLog.append('Object {} lost at time {} s.'.format(index, timeList[row]))
+                    #The frames after it are not kept
+                    for c in centerList[row+1:]:
+                        c[index-1] = (-1,-1)
+                    for IDs in ID_array[row+1:]:
+                        IDs.remove(index)
+                    break
     
     
         #Calculate the central position of the bounding boxes/particle
         centers = list()
+        boxIds = list()
 
         for index in ids:
             if not index in ID_array[-1]:
@@ -454,29 +825,23 @@ def main():
                 #Otherwise, the center is calculated according to the boundinb box dimensions
                 bbox = bboxes[index-1]
                 centers.append((int(bbox[0] + bbox[2]/2.),int(bbox[1] + bbox[3]/2.)))
-                if len(centerList) > framesStopped:
-                    #If the following happens, we consider it hasn't moved,
-                    #meaning it has lost the object
-                    #This is just a very simple way of considering the center of the particle
-                    #has barely changed in 10 frames, which means the particle has been lost
-                    #and the tracker is not following anything.
-                    awayFromCenter = sum([np.linalg.norm(np.array(c[index-1])-np.array(centerList[-1][index-1])) for c in centerList[-framesStopped:-1]])
-                    if awayFromCenter <= framesStopped:
-                        #If the particle has disappeared, we set its index in the
-                        #keepDict as False.
-                        keepDict[index] = False
-                        print('Object was lost')
-                        errorLog.append('Object {} was lost for {} seconds and tracker stopped at time {} s.'.format(index,
-                                                                                                                     round(framesStopped/fps,2),
-                                                                                                                     timeList[-1]))
-
-                        continue
+                if is_stuck(centerList, len(centerList), index, framesStopped):
+                    #If the particle has disappeared, we set its index in the
+                    #keepDict as False.
+                    keepDict[index] = False
+                    print('Object was lost')
+                    errorLog.append('Object {} was lost for {} seconds and tracker stopped at time {} s.'.format(index,
+                                                                                                                 round(framesStopped/fps,2),
+                                                                                                                 timeList[-1]))
+
+                    continue
                 #if the center of the tracked object has moved too much
                 #(a distance specified by the jump threshold)
+                #per frame since the last tracked frame,
                 #we consider it has moved to another particle and it stops
-                distance_x = (centerList[-1][index-1][0]-centers[-1][0])**2
-                distance_y = (centerList[-1][index-1][1]-centers[-1][1])**2
-                distance = np.sqrt(distance_x + distance_y)
+                distance_x = (lastCenters[index-1][0]-centers[-1][0])**2
+                distance_y = (lastCenters[index-1][1]-centers[-1][1])**2
+                distance = np.sqrt(distance_x + distance_y)/(len(skippedFrames)+1)
     
                 if distance > np.mean([bbox[2],bbox[3]])*JUMP_THRESHOLD:
                     #if the distance is more than the average dimension
@@ -487,101 +852,46 @@ def main():
                                                                                                np.mean([bbox[2],bbox[3]])*JUMP_THRESHOLD,
                                                                                                timeList[-1]))
                     centers[-1] = (-1,-1)
+                    #We don't know when it jumped, so the skipped frames are not kept either
+                    for c in centerList[len(centerList)-len(skippedFrames):]:
+                        c[index-1] = (-1,-1)
                     continue
-    
-        
-            # Draw bounding box
-            # only if the particle was not lost
-            if DISPLAY_BOX:
-                if f != 1:
-                    bboxScaled = tuple([b*f for b in bbox])
-                    p1Scaled = (int(bboxScaled[0]), int(bboxScaled[1]))
-                    p2Scaled = (int(bboxScaled[0] + bboxScaled[2]), int(bboxScaled[1] + bboxScaled[3]))
-                    cv2.rectangle(frameResized, p1Scaled, p2Scaled, (255,102,102),thickness=2)
-                p1 = (int(bbox[0]), int(bbox[1]))
-                p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
-                cv2.rectangle(frame, p1, p2, (255,102,102),thickness=2)
+            
+            #Bounding box will be drawn only if the particle was not lost
+            boxIds.append(index)
         
         #All the calculated centeres are appended to the list
         centerList.append(centers)        
         
-        #Loop through the CURRENT PARTICLES only
-        if DISPLAY_PARTICLE_NUMBER:
-            for k in range(len(ID_array[-1])):
-                label = ID_array[-1][k]
-                bbox = bboxes[label-1]
-                #This part adds the particle label next to the bounding box
-                if f != 1:
-                    bboxScaled = tuple([b*f for b in bbox])
-                    cv2.putText(frameResized, str(label), 
-                                (int(bboxScaled[0]+bboxScaled[2]),int(bboxScaled[1])), 
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255),2)
-                cv2.putText(frame, str(label), 
-                            (int(bbox[0]+bbox[2]),int(bbox[1])), 
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255),2)
+        #The stride for the next tracked frame is calculated
+        if ADAPTIVE_STRIDE:
+            stride = update_stride(stride, lastCenters, centers, bboxes, boxIds, len(skippedFrames)+1, maxStride)
         
-        #If we want to display the tracking with colors
-        if DISPLAY_TRACKING:
-            centerList_T = list(zip(*centerList))
-            for i, idx in enumerate(ID_array[-1]):
-                count2 = 0
-                for point1, point2 in zip(centerList_T[idx-1], centerList_T[idx-1][1:]): 
-                    if point1 != (-1,-1) and point2 != (-1,-1):
-                        color = (int(cmap[count2][2]*255),int(cmap[count2][1]*255),int(cmap[count2][0]*255))
-                        if f != 1:
-                            p1Scaled = tuple([int(p1*f) for p1 in point1])
-                            p2Scaled = tuple([int(p2*f) for p2 in point2])
-                            cv2.line(frameResized, p1Scaled, p2Scaled, color, 3)
-                        cv2.line(frame, point1, point2, color, 3) 
-                        count2 += 1
+        #The skipped frames and this one are drawn and written in order
+        framesToWrite = skippedFrames + [frame]
+        firstRow = len(centerList) - len(framesToWrite)
+        skippedFrames = list()
+        for j, frameToWrite in enumerate(framesToWrite):
+            row = firstRow + j
+            if row == len(centerList)-1:
+                frameBoxIds = boxIds
+            else:
+                frameBoxIds = [index for index in ID_array[row] if centerList[row][index-1] != (-1,-1)]
+            frameResized = draw_overlay(frameToWrite, bounding_box_list[row], frameBoxIds, ID_array[row],
+                                        centerList[:row+1], timeList[row], fps, cmap)
             
-    
-        # Display tracker type on frame
-        if DISPLAY_TRACKER:
-            if f != 1:
-                cv2.putText(frameResized, TRACKER_TYPE + " Tracker", (int(f*width*0.15),int(f*height*0.05+GENERAL_OFFSET*f)), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (50,170,50),2)
-            cv2.putText(frame, TRACKER_TYPE + " Tracker", (int(width*0.15),int(height*0.05)+GENERAL_OFFSET), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255),2)
-        
-        # Display FPS on frame
-        if DISPLAY_FPS:
-            if f != 1:
-                cv2.putText(frameResized, "FPS: " + str(fps), (int(f*width*0.15),int(f*height*0.05+GENERAL_OFFSET*f)+30), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (50,170,50), 2)
-            cv2.putText(frame, "FPS: " + str(fps), (int(width*0.15),int(height*0.05)+30+GENERAL_OFFSET), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255), 2)
-    
-        # Display elapsed time
-        if DISPLAY_TIME:
-            if f != 1:
-                cv2.putText(frameResized, "Time: " + "%.2f s" % elapsed, (int(f*width*0.15),int(f*height*0.05+GENERAL_OFFSET*f)+60), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (50,170,50), 2)     
-            cv2.putText(frame, "Time: " + "%.2f s" % elapsed, (int(width*0.15),int(height*0.05)+60+GENERAL_OFFSET), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255), 2)
-        
-        # Display scale bar
-        if DISPLAY_SCALE_BAR:
-            p1 = (int(width*0.7),int(height*0.07)+GENERAL_OFFSET)
-            p2 = (int(width*0.7+SCALE_NUMBER*SCALE),int(height*0.075)+GENERAL_OFFSET)
-            cv2.rectangle(frame, p1,p2, (255,255,255), -1)
-            if f != 1:
-                p1Scaled = (int(p1[0]*f),int(p1[1]*f))
-                p2Scaled = (int(p2[0]*f),int(p2[1]*f))
-                cv2.rectangle(frameResized, p1Scaled,p2Scaled, (255,255,255), -1)
-            if DISPLAY_SCALE_BAR_TEXT:
-                if f != 1:
-                    cv2.putText(frameResized,str(SCALE_NUMBER) + ' um',(int(f*width*0.7),int(f*height*0.06+GENERAL_OFFSET*f)),cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255), 2)
-                cv2.putText(frame,str(SCALE_NUMBER) + ' um',(int(width*0.72),int(height*0.06)+GENERAL_OFFSET),cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255,255,255), 2)
-    
-        
-        # Display result
-        if DISPLAY_VIDEO:
-            if f != 1:
+            # Display result
+            if DISPLAY_VIDEO:
                 cv2.imshow("Tracking", frameResized)
-            else:
-                cv2.imshow("Tracking", frame)        
+            
+            #Writes the frame in the out file
+            out.write(frameToWrite)
+         
+            # Exit if ESC pressed
+            k = cv2.waitKey(1) & 0xff
+            if k == 27 : break
         
-        #Writes the frame in the out file
-        out.write(frame)
-     
-        # Exit if ESC pressed
-        k = cv2.waitKey(1) & 0xff
-        if k == 27 : break
+        if k == 27 or videoEnded: break
     
     pbar.close() #Close progress bar
     cv2.destroyAllWindows()
@@ -597,6 +907,28 @@ def main():
     #Saves the contract correction value
     with open(Path(saveDir,file+'_contrastCorrection.txt'),'w') as f:
         f.write('alpha\t{}'.format(alpha))
+        #With the automatic contrast, the gain of each sampled frame is saved too
+        if AUTO_CONTRAST:
+            f.write('\nFrame\tGain\n')
+            for i, gain in zip(normalisation['sampleIndexes'], normalisation['gains']):
+                f.write('%d\t%.4f\n' % (i, gain))
+    
+    #Saves the settings used for the tracking
+    with open(Path(saveDir,file+'_settings.txt'),'w') as f:
+        f.write('DATE\t{}\n'.format(datetime.datetime.now().isoformat(sep=' ', timespec='seconds')))
+        f.write('FPS\t{}\n'.format(fps))
+        f.write('SCALE\t{}\n'.format(SCALE))
+        f.write('TRACKER_TYPE\t{}\n'.format(TRACKER_TYPE))
+        f.write('JUMP_THRESHOLD\t{}\n'.format(JUMP_THRESHOLD))
+        f.write('SECONDS_STOPPED\t{}\n'.format(SECONDS_STOPPED))
+        f.write('ADAPTIVE_STRIDE\t{}\n'.format(ADAPTIVE_STRIDE))
+        f.write('AUTO_CONTRAST\t{}\n'.format(AUTO_CONTRAST))
+    
+    #Saves the backgrounds of the automatic contrast
+    if AUTO_CONTRAST and NORMALISATION_BACKGROUND:
+        np.savez_compressed(Path(saveDir,file+'_background.npz'),
+                            frames=normalisation['sampleIndexes'],
+                            backgrounds=np.array(normalisation['backgrounds']))
     
     
     '''